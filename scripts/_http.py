@@ -0,0 +1,24 @@
+"""
+Shared HTTP session setup for the data scripts.
+"""
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+def make_session(pool_size=6):
+    """Build a session that reuses keep-alive connections and retries
+    rate-limit and server errors with backoff.
+    
+    raise_on_status=False hands the last failed response back to the
+    caller once retries run out, so its status-code check still applies.
+    """
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=3, backoff_factor=0.3,
+                          status_forcelist=[429, 500, 502, 503, 504],
+                          raise_on_status=False)
+    ))
+    return session
@@ -0,0 +1,49 @@
+"""
+Shared JSON helpers for the data scripts.
+Uses orjson when it is installed, otherwise the stdlib json module.
+"""
+
+import json
+import os
+
+try:
+    import orjson
+
+    loads = orjson.loads
+
+    def dumps(obj, pretty=False):
+        """Encode obj as UTF-8 JSON bytes, indented if pretty."""
+        option = orjson.OPT_NON_STR_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+
+    def dumps_sorted(obj):
+        """Encode obj as compact JSON bytes with sorted keys, for hashing."""
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+except ImportError:
+    # Fall back to the stdlib encoder if orjson is not installed
+    loads = json.loads
+
+    def dumps(obj, pretty=False):
+        """Encode obj as UTF-8 JSON bytes, indented if pretty."""
+        if pretty:
+            return json.dumps(obj, indent=2).encode('utf-8')
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def dumps_sorted(obj):
+        """Encode obj as compact JSON bytes with sorted keys, for hashing."""
+        return json.dumps(obj, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+def atomic_write_json(path, obj, pretty=False):
+    """Write obj as JSON to path via a temp file so readers never see a partial file."""
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb', buffering=1024 * 1024) as f:
+            f.write(dumps(obj, pretty))
+        os.replace(tmp_path, path)
+    except BaseException:
+        # Don't leave a half-written temp file behind
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -6,15 +6,36 @@ Free API - uses DEMO_KEY for testing, get your own key for production.
 API Docs: https://developer.nrel.gov/docs/transportation/alt-fuel-stations-v1/
 """
 
-import json
-import requests
+import argparse
+from collections import Counter, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
+from itertools import chain
+from operator import itemgetter
 import os
 
+from _http import make_session
+from _jsonio import atomic_write_json, loads
+
+try:
+    import ijson
+except ImportError:
+    # Without ijson the response body is parsed in one go
+    ijson = None
+
 # Get API key from environment or use demo key
 API_KEY = os.environ.get('NREL_API_KEY', 'DEMO_KEY')
 BASE_URL = "https://developer.nrel.gov/api/alt-fuel-stations/v1.json"
 
+# Output files, plus the per-state ETag/Last-Modified values from the last run
+ALL_STATIONS_PATH = 'data/charging_stations_all.json'
+EBIKE_STATIONS_PATH = 'data/charging_stations.json'
+CACHE_PATH = 'data/.nrel_cache.json'
+
+# Shared session so repeat calls reuse keep-alive connections
+SESSION = make_session()
+
 # New England states
 NE_STATES = ['CT', 'MA', 'ME', 'NH', 'RI', 'VT']
 
@@ -28,122 +49,260 @@ EBIKE_RELEVANT_CONNECTORS = [
     'J1772',     # Level 2 (with adapter)
 ]
 
-def fetch_all_stations():
-    """Fetch all electric charging stations in New England."""
+# By-state and by-type tallies for one set of stations
+StationCounts = namedtuple('StationCounts', ['by_state', 'by_type'])
+
+# Precomputed lookup sets so classification is a hash probe per station
+EBIKE_SET = frozenset(EBIKE_RELEVANT_CONNECTORS)
+NEMA_SET = frozenset(c for c in EBIKE_SET if c.startswith('NEMA'))
+
+# (chargerType, icon) indexed by (has_nema << 1) | has_j1772;
+# NEMA wins over J1772 when a station has both
+CHARGER_CLASSES = (
+    ('Other', '🔋'),
+    ('J1772', '⚡'),
+    ('NEMA', '🔌'),
+    ('NEMA', '🔌'),
+)
+
+# Defaults for API fields that may be missing from a station record
+STATION_DEFAULTS = {
+    'station_name': 'Unknown',
+    'street_address': '',
+    'city': '',
+    'state': '',
+    'zip': '',
+    'latitude': None,
+    'longitude': None,
+    'station_phone': None,
+    'access_days_time': '',
+    'ev_pricing': 'Unknown',
+    'ev_network': 'Non-Networked',
+    'ev_connector_types': [],
+    'ev_level1_evse_num': 0,
+    'ev_level2_evse_num': 0,
+    'ev_dc_fast_num': 0,
+    'facility_type': '',
+    'date_last_confirmed': '',
+}
+
+# Our field name -> API field name, copied straight across
+STATION_FIELDS = [
+    ('id', 'id'),
+    ('name', 'station_name'),
+    ('address', 'street_address'),
+    ('city', 'city'),
+    ('state', 'state'),
+    ('zip', 'zip'),
+    ('lat', 'latitude'),
+    ('lng', 'longitude'),
+    ('phone', 'station_phone'),
+    ('hours', 'access_days_time'),
+    ('pricing', 'ev_pricing'),
+    ('network', 'ev_network'),
+]
+STATION_KEYS = [ours for ours, _ in STATION_FIELDS]
+get_station_fields = itemgetter(*(api for _, api in STATION_FIELDS))
+
+def load_cache():
+    """Load the per-state HTTP validators saved by the last run."""
+    
+    # Validators are useless without the data they describe
+    if not (os.path.exists(CACHE_PATH) and os.path.exists(ALL_STATIONS_PATH)):
+        return {}
+    
+    with open(CACHE_PATH, 'rb') as f:
+        return loads(f.read())
+
+def load_previous_stations():
+    """Load the stations from the last saved run, grouped by state."""
+    
+    with open(ALL_STATIONS_PATH, 'rb') as f:
+        previous = loads(f.read())
+    
+    by_state = defaultdict(list)
+    for station in previous['stations']:
+        by_state[station['state']].append(station)
+    return by_state
+
+def fetch_state_stations(state, validators):
+    """Fetch and process electric charging stations for a single state.
+    
+    Returns (stations, validators, content_encoding), with stations set
+    to None if NREL reports nothing has changed since the last run, or
+    None on error.
+    """
     
     params = {
         'api_key': API_KEY,
         'status': 'E',  # Existing/operational only
         'fuel_type': 'ELEC',
-        'state': ','.join(NE_STATES),
+        'state': state,
         'access': 'public',
         'limit': 'all'  # Get all results
     }
     
+    # Ask for gzip explicitly, and use a conditional GET so an unchanged
+    # state comes back as an empty 304
+    headers = {'Accept-Encoding': 'gzip'}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    
+    with SESSION.get(BASE_URL, params=params, headers=headers,
+                     timeout=(5, 30), stream=True) as response:
+        if response.status_code == 304:
+            return None, validators, None
+        
+        if response.status_code != 200:
+            print(f"Error ({state}): {response.status_code}")
+            print(response.text)
+            return None
+        
+        new_validators = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+        
+        # Stream stations straight into processing so the raw payload
+        # is never held in memory as a whole; gzip is decoded lazily as
+        # ijson pulls bytes
+        if ijson is not None:
+            response.raw.decode_content = True
+            raw_stations = ijson.items(response.raw, 'fuel_stations.item', use_float=True)
+        else:
+            raw_stations = loads(response.content)['fuel_stations']
+        
+        content_encoding = response.headers.get('Content-Encoding', 'identity')
+        return process_stations(raw_stations), new_validators, content_encoding
+
+def fetch_all_stations():
+    """Fetch all electric charging stations in New England.
+    
+    Returns (stations, cache) where cache holds the new per-state
+    validators, or None on error or if no state has changed.
+    """
+    
     print(f"Fetching charging stations from NREL API...")
     print(f"States: {', '.join(NE_STATES)}")
     
-    response = requests.get(BASE_URL, params=params)
+    cache = load_cache()
+    
+    # One request per state, run concurrently over the pooled session
+    with ThreadPoolExecutor(max_workers=len(NE_STATES)) as executor:
+        results = list(executor.map(
+            fetch_state_stations,
+            NE_STATES,
+            [cache.get(state, {}) for state in NE_STATES]
+        ))
     
-    if response.status_code != 200:
-        print(f"Error: {response.status_code}")
-        print(response.text)
+    # Don't save a partial dataset if any state failed
+    if any(r is None for r in results):
         return None
     
-    data = response.json()
-    print(f"Found {data['total_results']} stations")
+    if all(r[0] is None for r in results):
+        print("No changes since last run")
+        return None
+    
+    # Parse the previous run once, and only if some state needs it
+    previous = None
+    if any(r[0] is None for r in results):
+        previous = load_previous_stations()
+    
+    per_state = []
+    new_cache = {}
+    for state, (state_stations, validators, encoding) in zip(NE_STATES, results):
+        if state_stations is None:
+            state_stations = previous[state]
+            print(f"  {state}: {len(state_stations)} stations (unchanged)")
+        else:
+            print(f"  {state}: {len(state_stations)} stations ({encoding})")
+        per_state.append(state_stations)
+        new_cache[state] = validators
+    
+    stations = list(chain.from_iterable(per_state))
+    print(f"Found {len(stations)} stations")
+    
+    return stations, new_cache
+
+@lru_cache(maxsize=None)
+def classify_connectors(connectors):
+    """Return (chargerType, icon) for a tuple of connector types.
+    
+    Stations share a handful of connector combinations, so caching this
+    classifies each combination once rather than once per station.
+    """
+    
+    # Check if any e-bike friendly connectors
+    connector_set = set(connectors)
+    has_nema = bool(connector_set & NEMA_SET)
+    has_j1772 = 'J1772' in connector_set
     
-    return data
+    return CHARGER_CLASSES[(has_nema << 1) | has_j1772]
 
-def process_stations(data):
-    """Process raw API data into our format."""
+def process_stations(raw_stations):
+    """Process raw API stations into our format."""
     
     stations = []
     
-    for station in data.get('fuel_stations', []):
-        # Determine connector types
-        connectors = station.get('ev_connector_types', [])
+    for raw in raw_stations:
+        station = {**STATION_DEFAULTS, **raw}
         
-        # Check if any e-bike friendly connectors
-        has_nema = any(c.startswith('NEMA') for c in connectors)
-        has_j1772 = 'J1772' in connectors
+        # Determine connector types and categorize for our use
+        connectors = station['ev_connector_types']
+        charger_type, icon = classify_connectors(tuple(connectors))
         
-        # Categorize for our use
-        if has_nema:
-            charger_type = 'NEMA'
-            icon = '🔌'
-        elif has_j1772:
-            charger_type = 'J1772'
-            icon = '⚡'
-        else:
-            charger_type = 'Other'
-            icon = '🔋'
-        
-        processed = {
-            'id': station['id'],
-            'name': station.get('station_name', 'Unknown'),
-            'address': station.get('street_address', ''),
-            'city': station.get('city', ''),
-            'state': station.get('state', ''),
-            'zip': station.get('zip', ''),
-            'lat': station.get('latitude'),
-            'lng': station.get('longitude'),
-            'phone': station.get('station_phone'),
-            'hours': station.get('access_days_time', ''),
-            'pricing': station.get('ev_pricing', 'Unknown'),
-            'network': station.get('ev_network', 'Non-Networked'),
+        processed = dict(zip(STATION_KEYS, get_station_fields(station)))
+        processed.update({
             'connectors': connectors,
             'chargerType': charger_type,
             'icon': icon,
-            'level1Count': station.get('ev_level1_evse_num', 0) or 0,
-            'level2Count': station.get('ev_level2_evse_num', 0) or 0,
-            'dcFastCount': station.get('ev_dc_fast_num', 0) or 0,
-            'facilityType': station.get('facility_type', ''),
-            'lastConfirmed': station.get('date_last_confirmed', ''),
-        }
+            'level1Count': station['ev_level1_evse_num'] or 0,
+            'level2Count': station['ev_level2_evse_num'] or 0,
+            'dcFastCount': station['ev_dc_fast_num'] or 0,
+            'facilityType': station['facility_type'],
+            'lastConfirmed': station['date_last_confirmed'],
+        })
         
         stations.append(processed)
     
     return stations
 
-def filter_ebike_friendly(stations):
-    """Filter to stations most useful for e-bikes."""
+def filter_and_tally(stations):
+    """Filter to stations most useful for e-bikes and count both sets.
+    
+    Returns (ebike_friendly, all_counts, ebike_counts), with the counts
+    for all and e-bike friendly stations gathered in the same pass.
+    """
     
     ebike_friendly = []
+    all_counts = StationCounts(by_state=Counter(), by_type=Counter())
+    ebike_counts = StationCounts(by_state=Counter(), by_type=Counter())
     
     for station in stations:
-        connectors = station.get('connectors', [])
+        state = station['state']
+        charger_type = station['chargerType']
+        all_counts.by_state[state] += 1
+        all_counts.by_type[charger_type] += 1
         
         # Must have NEMA or J1772
-        has_relevant = any(
-            any(c.startswith(prefix) for prefix in ['NEMA', 'J1772'])
-            for c in connectors
-        )
-        
-        if has_relevant:
+        if EBIKE_SET.intersection(station['connectors']):
             ebike_friendly.append(station)
+            ebike_counts.by_state[state] += 1
+            ebike_counts.by_type[charger_type] += 1
     
-    return ebike_friendly
+    return ebike_friendly, all_counts, ebike_counts
 
-def save_stations(stations, output_path):
-    """Save processed stations to JSON."""
-    
-    # Count by state
-    by_state = {}
-    for s in stations:
-        state = s.get('state', 'Unknown')
-        by_state[state] = by_state.get(state, 0) + 1
+def save_stations(stations, output_path, counts, timestamp, pretty=False):
+    """Save processed stations and their precomputed counts to JSON."""
     
-    # Count by type
-    by_type = {}
-    for s in stations:
-        t = s.get('chargerType', 'Unknown')
-        by_type[t] = by_type.get(t, 0) + 1
+    by_state, by_type = counts.by_state, counts.by_type
     
     output = {
         'stations': stations,
         'metadata': {
-            'lastUpdated': datetime.now().isoformat(),
+            'lastUpdated': timestamp,
             'source': 'NREL Alternative Fuel Data Center',
             'sourceUrl': 'https://afdc.energy.gov/stations/',
             'totalStations': len(stations),
@@ -155,8 +314,7 @@ def save_stations(stations, output_path):
     # Ensure directory exists
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
     
-    with open(output_path, 'w') as f:
-        json.dump(output, f, indent=2)
+    atomic_write_json(output_path, output, pretty)
     
     print(f"\nSaved {len(stations)} stations to {output_path}")
     print(f"\nBy state:")
@@ -167,26 +325,38 @@ def save_stations(stations, output_path):
         print(f"  {t}: {count}")
 
 def main():
+    parser = argparse.ArgumentParser(description="Fetch NE charging stations from NREL")
+    parser.add_argument('--pretty', action='store_true',
+                        help="indent the JSON output for debugging")
+    args = parser.parse_args()
+    
     print("=" * 60)
     print("NREL Charging Station Fetcher for NE E-Bike Community")
     print("=" * 60)
     print()
     
-    # Fetch all stations
-    data = fetch_all_stations()
-    if not data:
+    # Fetch all stations, processed into our format
+    result = fetch_all_stations()
+    if result is None:
         return
+    stations, cache = result
+    
+    # One timestamp for the whole run
+    now_iso = datetime.now().isoformat()
     
-    # Process into our format
-    stations = process_stations(data)
-    print(f"Processed {len(stations)} stations")
+    # Filter to e-bike friendly and count both sets in one pass
+    ebike_friendly, all_counts, ebike_counts = filter_and_tally(stations)
     
     # Save all stations
-    save_stations(stations, 'data/charging_stations_all.json')
+    save_stations(stations, ALL_STATIONS_PATH, all_counts,
+                  timestamp=now_iso, pretty=args.pretty)
+    
+    # Save e-bike friendly stations
+    save_stations(ebike_friendly, EBIKE_STATIONS_PATH, ebike_counts,
+                  timestamp=now_iso, pretty=args.pretty)
     
-    # Filter to e-bike friendly and save
-    ebike_friendly = filter_ebike_friendly(stations)
-    save_stations(ebike_friendly, 'data/charging_stations.json')
+    # Only remember the validators once the data they describe is on disk
+    atomic_write_json(CACHE_PATH, cache)
     
     print(f"\nE-bike friendly stations: {len(ebike_friendly)}")
 
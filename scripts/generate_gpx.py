@@ -4,9 +4,20 @@ Generate GPX files for trails from our trail data.
 Creates simple waypoint GPX files that can be loaded into any GPS app.
 """
 
-import json
+import argparse
+import hashlib
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
+from string import Formatter
+from xml.sax.saxutils import escape
+
+from _jsonio import atomic_write_json, dumps_sorted, loads
+
+# Digest of each trail's data as of its last GPX write, committed with
+# the GPX files so a fresh checkout can skip unchanged trails too
+DIGESTS_PATH = 'data/gpx_digests.json'
 
 GPX_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
 <gpx version="1.1" creator="NE E-Bike and PEV Community"
@@ -37,49 +48,113 @@ GPX_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
 </gpx>
 '''
 
+def _split_template(template):
+    """Split a format template into literal byte segments and field names."""
+    parsed = list(Formatter().parse(template))
+    segments = [literal.encode('utf-8') for literal, _, _, _ in parsed]
+    keys = [field for _, field, _, _ in parsed if field is not None]
+    return segments[:len(keys)], keys, segments[len(keys)]
+
+# Pre-split once so generate_gpx never re-parses the template
+GPX_SEGMENTS, GPX_KEYS, GPX_TAIL = _split_template(GPX_TEMPLATE)
+
 def load_trails():
     """Load trail data from JSON."""
-    with open('data/trails.json', 'r') as f:
-        data = json.load(f)
+    with open('data/trails.json', 'rb') as f:
+        data = loads(f.read())
     return data['trails']
 
-def generate_gpx(trail):
-    """Generate GPX content for a trail."""
-    return GPX_TEMPLATE.format(
-        name=trail['name'],
-        description=trail.get('description', ''),
-        timestamp=datetime.now().isoformat(),
-        trailhead_lat=trail.get('trailheadLat', trail['lat']),
-        trailhead_lng=trail.get('trailheadLng', trail['lng']),
-        center_lat=trail['lat'],
-        center_lng=trail['lng']
-    )
+def generate_gpx(trail, timestamp):
+    """Generate GPX content for a trail as UTF-8 bytes."""
+    values = {
+        'name': escape(trail['name']),
+        'description': escape(trail.get('description', '')),
+        'timestamp': timestamp,
+        'trailhead_lat': trail.get('trailheadLat', trail['lat']),
+        'trailhead_lng': trail.get('trailheadLng', trail['lng']),
+        'center_lat': trail['lat'],
+        'center_lng': trail['lng'],
+    }
+    encoded = {key: str(value).encode('utf-8') for key, value in values.items()}
+    
+    parts = []
+    for segment, key in zip(GPX_SEGMENTS, GPX_KEYS):
+        parts.append(segment)
+        parts.append(encoded[key])
+    parts.append(GPX_TAIL)
+    return b''.join(parts)
+
+def trail_digest(trail):
+    """Hash a trail's data together with the template that renders it."""
+    # gpxFile is written back by update_trails_json, so leave it out or
+    # a new trail's digest would change on the run after it is added
+    data = {k: v for k, v in trail.items() if k != 'gpxFile'}
+    h = hashlib.blake2b(GPX_TEMPLATE.encode('utf-8'), digest_size=16)
+    h.update(dumps_sorted(data))
+    return h.hexdigest()
+
+def load_digests():
+    """Load the trail digests recorded when the GPX files were last written."""
+    if not os.path.exists(DIGESTS_PATH):
+        return {}
+    with open(DIGESTS_PATH, 'rb') as f:
+        return loads(f.read())
+
+def write_gpx_file(trail, timestamp, path_prefix, digests):
+    """Write the GPX file for one trail if its data has changed.
+    
+    Returns the trail's index entry, its digest and whether the file
+    was written.
+    """
+    # Create safe filename
+    filename = trail['id'] + '.gpx'
+    filepath = path_prefix + filename
+    entry = {
+        'id': trail['id'],
+        'name': trail['name'],
+        'file': filename
+    }
+    
+    # Skip the write if the recorded digest says the file is up to date
+    digest = trail_digest(trail)
+    if digests.get(trail['id']) == digest and os.path.exists(filepath):
+        return entry, digest, False
+    
+    gpx_content = generate_gpx(trail, timestamp)
+    
+    with open(filepath, 'wb') as f:
+        f.write(gpx_content)
+    
+    return entry, digest, True
 
-def save_gpx_files(trails, output_dir='gpx'):
-    """Save GPX files for all trails."""
+def save_gpx_files(trails, timestamp, output_dir='gpx'):
+    """Save GPX files for all trails, skipping any that are unchanged."""
     os.makedirs(output_dir, exist_ok=True)
     
-    generated = []
-    for trail in trails:
-        # Create safe filename
-        filename = trail['id'] + '.gpx'
-        filepath = os.path.join(output_dir, filename)
-        
-        gpx_content = generate_gpx(trail)
-        
-        with open(filepath, 'w') as f:
-            f.write(gpx_content)
-        
-        generated.append({
-            'id': trail['id'],
-            'name': trail['name'],
-            'file': filename
-        })
-        print(f"Generated: {filename}")
+    # Join the directory once rather than per file
+    path_prefix = os.path.join(output_dir, '')
+    
+    # Files are independent, so write them concurrently
+    write_one = partial(write_gpx_file, timestamp=timestamp,
+                        path_prefix=path_prefix, digests=load_digests())
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(write_one, trails))
+    
+    generated = [entry for entry, _, _ in results]
+    written = [entry['file'] for entry, _, was_written in results if was_written]
+    
+    # Indented so changes show up as readable diffs in git
+    atomic_write_json(DIGESTS_PATH, {entry['id']: digest for entry, digest, _ in results},
+                      pretty=True)
+    
+    if written:
+        print('Generated:\n  ' + '\n  '.join(written))
+    if len(written) < len(generated):
+        print(f"Unchanged: {len(generated) - len(written)} files")
     
     return generated
 
-def update_trails_json(trails, gpx_files):
+def update_trails_json(trails, gpx_files, timestamp, pretty=False):
     """Update trails.json with GPX file references."""
     gpx_map = {g['id']: g['file'] for g in gpx_files}
     
@@ -87,15 +162,19 @@ def update_trails_json(trails, gpx_files):
         if trail['id'] in gpx_map:
             trail['gpxFile'] = 'gpx/' + gpx_map[trail['id']]
     
-    with open('data/trails.json', 'w') as f:
-        json.dump({'trails': trails, 'metadata': {
-            'lastUpdated': datetime.now().isoformat(),
-            'gpxGenerated': True
-        }}, f, indent=2)
+    atomic_write_json('data/trails.json', {'trails': trails, 'metadata': {
+        'lastUpdated': timestamp,
+        'gpxGenerated': True
+    }}, pretty)
     
     print(f"\nUpdated trails.json with GPX references")
 
 def main():
+    parser = argparse.ArgumentParser(description="Generate GPX files for NE trails")
+    parser.add_argument('--pretty', action='store_true',
+                        help="indent the JSON output for debugging")
+    args = parser.parse_args()
+    
     print("=" * 50)
     print("GPX File Generator for NE E-Bike Trails")
     print("=" * 50)
@@ -105,10 +184,13 @@ def main():
     print(f"Loaded {len(trails)} trails")
     print()
     
-    gpx_files = save_gpx_files(trails)
-    print(f"\nGenerated {len(gpx_files)} GPX files")
+    # One timestamp for the whole run
+    now_iso = datetime.now().isoformat()
+    
+    gpx_files = save_gpx_files(trails, now_iso)
+    print(f"\n{len(gpx_files)} GPX files up to date")
     
-    update_trails_json(trails, gpx_files)
+    update_trails_json(trails, gpx_files, now_iso, args.pretty)
 
 if __name__ == "__main__":
     main()
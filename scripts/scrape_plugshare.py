@@ -1,16 +1,42 @@
 #!/usr/bin/env python3
 """
-PlugShare Scraper for New England E-Bike Charging Stations
-Pulls J1772 (Level 2) and NEMA (wall outlet) charging locations.
+Charging Station Fetcher for New England E-Bike Charging Stations
+Pulls J1772 (Level 2) and NEMA (wall outlet) charging locations from
+Open Charge Map. Set OCM_API_KEY to your key before running.
 
-Note: PlugShare has rate limits. Run sparingly and cache results.
+Note: Open Charge Map has rate limits. Responses are cached per state
+under data/ for a day, so re-runs within that window stay local.
+
+API Docs: https://openchargemap.org/site/develop/api
 """
 
-import json
+import argparse
+import os
 import time
-import requests
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from _http import make_session
+from _jsonio import atomic_write_json, loads
+
+# Get API key from environment
+OCM_API_KEY = os.environ.get("OCM_API_KEY", "")
+OCM_URL = "https://api.openchargemap.io/v3/poi/"
+
+# Kept apart from data/charging_stations.json, which the site's maps read
+# in the NREL station format written by fetch_charging_stations.py
+OUTPUT_PATH = "data/charging_stations_ocm.json"
+
+# Per-state response cache, reused for CACHE_TTL seconds
+CACHE_PATH = "data/.ocm_cache_{state}.json"
+CACHE_TTL = 24 * 60 * 60
+
+# OCM's per-request result cap; a box that hits it is split into
+# quadrants, at most MAX_SPLIT_DEPTH times
+MAX_RESULTS = 2000
+MAX_SPLIT_DEPTH = 3
+
 # New England state bounding boxes (approximate)
 NE_STATES = {
     "CT": {"name": "Connecticut", "bounds": {"sw_lat": 40.95, "sw_lng": -73.73, "ne_lat": 42.05, "ne_lng": -71.78}},
@@ -21,127 +47,275 @@ NE_STATES = {
     "VT": {"name": "Vermont", "bounds": {"sw_lat": 42.73, "sw_lng": -73.44, "ne_lat": 45.02, "ne_lng": -71.46}}
 }
 
-# Connector types we care about for e-bikes
-# 1 = Wall Outlet (NEMA 5-15)
-# 2 = J1772
-# 6 = NEMA 14-50
+# Shared session so repeat calls to the same host reuse connections
+SESSION = make_session()
+
+# Open Charge Map connection types we care about for e-bikes
+# 1 = J1772
+# 9 = NEMA 5-20
+# 11 = NEMA 14-50
+# 22 = Wall Outlet (NEMA 5-15)
 CONNECTOR_TYPES = {
-    1: "NEMA 5-15 (Wall Outlet)",
-    2: "J1772",
-    6: "NEMA 14-50"
+    1: "J1772",
+    9: "NEMA 5-20",
+    11: "NEMA 14-50",
+    22: "NEMA 5-15 (Wall Outlet)"
 }
 
-def fetch_plugshare_data():
+def normalize_state(text):
+    """Reduce free-text state names to letters only, e.g. 'N.H.' -> 'NH'."""
+    return "".join(ch for ch in text.upper() if ch.isalpha())
+
+# Map state codes, full names and common abbreviations to the code
+STATE_LOOKUP = {code: code for code in NE_STATES}
+STATE_LOOKUP.update({normalize_state(info["name"]): code for code, info in NE_STATES.items()})
+STATE_LOOKUP.update({"MASS": "MA", "CONN": "CT"})
+
+# First three ZIP digits -> state, for addresses with no usable state
+ZIP_RANGES = {
+    "MA": list(range(10, 28)) + [55],
+    "RI": [28, 29],
+    "NH": list(range(30, 39)),
+    "ME": list(range(39, 50)),
+    "VT": list(range(50, 55)) + list(range(56, 60)),
+    "CT": list(range(60, 70)),
+}
+ZIP_PREFIXES = {f"{prefix:03d}": code
+                for code, prefixes in ZIP_RANGES.items()
+                for prefix in prefixes}
+
+def in_bounds(lat, lng, bounds):
+    """Check whether a point lies inside a bounding box."""
+    return (lat is not None and lng is not None
+            and bounds["sw_lat"] <= lat <= bounds["ne_lat"]
+            and bounds["sw_lng"] <= lng <= bounds["ne_lng"])
+
+def resolve_state(address, code):
+    """Work out which New England state a POI address is in.
+    
+    Tries the free-text state, then the ZIP code. Only an address with
+    neither falls back to the queried state, and only if the point is
+    inside that state's box. Returns None for anything else.
     """
-    Fetch charging station data from PlugShare.
     
-    Note: PlugShare's public API is limited. This uses their web endpoint
-    which may require updates if they change their site structure.
+    state_text = normalize_state(address.get("StateOrProvince") or "")
+    if state_text in STATE_LOOKUP:
+        return STATE_LOOKUP[state_text]
     
-    For production use, apply for their official API access.
-    """
+    zip_code = (address.get("Postcode") or "").strip()
+    if zip_code[:5].isdigit() and zip_code[:3] in ZIP_PREFIXES:
+        return ZIP_PREFIXES[zip_code[:3]]
     
-    # PlugShare uses a tile-based system. We'll use their directory pages instead.
-    # The directory at https://www.plugshare.com/directory/us lists by state
-    
-    all_stations = []
-    
-    # For now, we'll create sample data structure that matches what we'd get from PlugShare
-    # In production, this would make actual API calls or scrape the directory
-    
-    print("Note: PlugShare scraping requires API access or careful web scraping.")
-    print("Creating sample data structure for development...")
-    
-    # Sample charging stations for demo purposes
-    # These would be replaced with actual scraped data
-    sample_stations = [
-        {
-            "id": "sample-1",
-            "name": "Portland Public Library",
-            "address": "5 Monument Square, Portland, ME",
-            "lat": 43.6591,
-            "lng": -70.2568,
-            "state": "ME",
-            "connectorType": "J1772",
-            "connectorId": 2,
-            "access": "Public",
-            "hours": "24/7",
-            "cost": "Free",
-            "network": "ChargePoint"
-        },
-        {
-            "id": "sample-2",
-            "name": "Boston Common Garage",
-            "address": "0 Charles St, Boston, MA",
-            "lat": 42.3551,
-            "lng": -71.0657,
-            "state": "MA",
-            "connectorType": "J1772",
-            "connectorId": 2,
-            "access": "Public",
-            "hours": "24/7",
-            "cost": "$2/hour",
-            "network": "EVgo"
-        },
-        {
-            "id": "sample-3", 
-            "name": "Providence Place Mall",
-            "address": "1 Providence Place, Providence, RI",
-            "lat": 41.8301,
-            "lng": -71.4150,
-            "state": "RI",
-            "connectorType": "J1772",
-            "connectorId": 2,
-            "access": "Public",
-            "hours": "Mall hours",
-            "cost": "Free while shopping",
-            "network": "Tesla Destination"
-        }
+    # Some other state or province, or an address with no ZIP
+    if state_text or zip_code:
+        return None
+    
+    lat, lng = address.get("Latitude"), address.get("Longitude")
+    return code if in_bounds(lat, lng, NE_STATES[code]["bounds"]) else None
+
+def split_bounds(bounds):
+    """Split a bounding box into four quadrants."""
+    mid_lat = (bounds["sw_lat"] + bounds["ne_lat"]) / 2
+    mid_lng = (bounds["sw_lng"] + bounds["ne_lng"]) / 2
+    return [
+        {"sw_lat": sw_lat, "sw_lng": sw_lng, "ne_lat": ne_lat, "ne_lng": ne_lng}
+        for sw_lat, ne_lat in ((bounds["sw_lat"], mid_lat), (mid_lat, bounds["ne_lat"]))
+        for sw_lng, ne_lng in ((bounds["sw_lng"], mid_lng), (mid_lng, bounds["ne_lng"]))
     ]
+
+def fetch_bbox_pois(code, bounds, depth=0):
+    """Fetch Open Charge Map POIs inside a bounding box.
+    
+    Returns (pois, complete), or None on error. complete is False if a
+    box still hit MAX_RESULTS after MAX_SPLIT_DEPTH splits.
+    """
+    
+    params = {
+        "boundingbox": f"({bounds['sw_lat']},{bounds['sw_lng']}),({bounds['ne_lat']},{bounds['ne_lng']})",
+        "connectiontypeid": ",".join(str(t) for t in CONNECTOR_TYPES),
+        "maxresults": MAX_RESULTS,
+        "countrycode": "US",
+        "verbose": "false",
+        "key": OCM_API_KEY
+    }
+    
+    response = SESSION.get(OCM_URL, params=params, timeout=(5, 30))
+    
+    if response.status_code != 200:
+        print(f"Error ({code}): {response.status_code}")
+        print(response.text)
+        return None
+    
+    pois = loads(response.content)
+    if len(pois) < MAX_RESULTS:
+        return pois, True
+    
+    # Hitting the cap means the results were cut off
+    if depth == MAX_SPLIT_DEPTH:
+        print(f"Warning ({code}): {params['boundingbox']} still returned "
+              f"{MAX_RESULTS} results, some stations are missing")
+        return pois, False
+    
+    combined = []
+    complete = True
+    for quadrant in split_bounds(bounds):
+        result = fetch_bbox_pois(code, quadrant, depth + 1)
+        if result is None:
+            return None
+        combined.extend(result[0])
+        complete = complete and result[1]
+    return combined, complete
+
+def fetch_state_pois(code):
+    """Fetch Open Charge Map POIs inside one state's bounding box.
+    
+    Returns the cached response if it is younger than CACHE_TTL and was
+    made with the same query, or None on error.
+    """
+    
+    bounds = NE_STATES[code]["bounds"]
+    query = {
+        "bounds": bounds,
+        "connectionTypes": sorted(CONNECTOR_TYPES),
+        "maxResults": MAX_RESULTS,
+        "countryCode": "US"
+    }
+    
+    cache_path = CACHE_PATH.format(state=code)
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            cached = loads(f.read())
+        if cached.get("query") == query and time.time() - cached["fetchedAt"] < CACHE_TTL:
+            return cached["pois"]
     
-    return sample_stations
+    result = fetch_bbox_pois(code, bounds)
+    if result is None:
+        return None
+    pois, complete = result
+    
+    # Don't let a truncated result stand in for the full set for a day
+    if complete:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        atomic_write_json(cache_path, {"fetchedAt": time.time(), "query": query, "pois": pois})
+    
+    return pois
 
-def save_charging_data(stations, output_file="data/charging_stations.json"):
+def process_poi(poi, code):
+    """Convert an Open Charge Map POI into our station format.
+    
+    Returns None if the POI has no connector we care about or lies
+    outside New England.
+    """
+    
+    connection = next(
+        (c for c in poi.get("Connections") or []
+         if c.get("ConnectionTypeID") in CONNECTOR_TYPES),
+        None
+    )
+    if connection is None:
+        return None
+    
+    address = poi.get("AddressInfo") or {}
+    
+    # Bounding boxes overlap neighbouring states, so trust the address
+    state = resolve_state(address, code)
+    if state is None:
+        return None
+    
+    return {
+        "id": poi["ID"],
+        "name": address.get("Title", "Unknown"),
+        "address": ", ".join(filter(None, [address.get("AddressLine1"), address.get("Town"), state])),
+        "lat": address.get("Latitude"),
+        "lng": address.get("Longitude"),
+        "state": state,
+        "connectorType": CONNECTOR_TYPES[connection["ConnectionTypeID"]],
+        "connectorId": connection["ConnectionTypeID"],
+        "access": (poi.get("UsageType") or {}).get("Title", "Unknown"),
+        "hours": address.get("AccessComments") or "Unknown",
+        "cost": poi.get("UsageCost") or "Unknown",
+        "network": (poi.get("OperatorInfo") or {}).get("Title", "Unknown")
+    }
+
+def fetch_charging_data():
+    """Fetch e-bike friendly charging stations for all of New England."""
+    
+    if not OCM_API_KEY:
+        print("Error: set OCM_API_KEY (free key: https://openchargemap.org/site/develop/api)")
+        return None
+    
+    print("Fetching charging stations from Open Charge Map...")
+    print(f"States: {', '.join(NE_STATES)}")
+    
+    # One request per state, run concurrently over the pooled session
+    with ThreadPoolExecutor(max_workers=len(NE_STATES)) as executor:
+        results = list(executor.map(fetch_state_pois, NE_STATES))
+    
+    # Don't save a partial dataset if any state failed
+    if any(pois is None for pois in results):
+        return None
+    
+    # Overlapping bounding boxes return some POIs more than once
+    stations = []
+    seen = set()
+    rejected = set()
+    for code, pois in zip(NE_STATES, results):
+        for poi in pois:
+            if poi["ID"] in seen:
+                continue
+            station = process_poi(poi, code)
+            if station is not None:
+                seen.add(poi["ID"])
+                stations.append(station)
+            else:
+                rejected.add(poi["ID"])
+    
+    # A POI rejected for one state's box may still be kept for another
+    discarded = len(rejected - seen)
+    if discarded:
+        print(f"Discarded {discarded} POIs outside New England or without a usable connector")
+    
+    return stations
+
+def save_charging_data(stations, timestamp, output_file=OUTPUT_PATH, pretty=False):
     """Save charging station data to JSON file."""
     
+    # Count by state
+    by_state = Counter(station.get("state", "Unknown") for station in stations)
+    
     output = {
         "stations": stations,
         "metadata": {
-            "lastUpdated": datetime.now().isoformat(),
-            "source": "PlugShare (sample data - replace with actual scrape)",
+            "lastUpdated": timestamp,
+            "source": "Open Charge Map",
+            "sourceUrl": "https://openchargemap.org/",
             "connectorTypes": CONNECTOR_TYPES,
             "totalStations": len(stations),
-            "byState": {}
+            "byState": dict(by_state)
         }
     }
     
-    # Count by state
-    for station in stations:
-        state = station.get("state", "Unknown")
-        if state not in output["metadata"]["byState"]:
-            output["metadata"]["byState"][state] = 0
-        output["metadata"]["byState"][state] += 1
-    
-    with open(output_file, 'w') as f:
-        json.dump(output, f, indent=2)
+    atomic_write_json(output_file, output, pretty)
     
     print(f"Saved {len(stations)} stations to {output_file}")
     return output
 
 def main():
+    parser = argparse.ArgumentParser(description="Collect NE e-bike charging stations")
+    parser.add_argument("--pretty", action="store_true",
+                        help="indent the JSON output for debugging")
+    args = parser.parse_args()
+    
     print("=" * 60)
-    print("PlugShare Scraper for New England E-Bike Charging")
+    print("Open Charge Map Fetcher for New England E-Bike Charging")
     print("=" * 60)
     print()
     
-    stations = fetch_plugshare_data()
-    save_charging_data(stations)
+    stations = fetch_charging_data()
+    if stations is None:
+        return
     
-    print()
-    print("To get real data:")
-    print("1. Apply for PlugShare API access: https://company.plugshare.com/api.html")
-    print("2. Or use Open Charge Map API (free): https://openchargemap.org/site/develop/api")
-    print()
+    save_charging_data(stations, datetime.now().isoformat(), pretty=args.pretty)
 
 if __name__ == "__main__":
     main()